@@ -1,11 +1,74 @@
+import os
+import asyncio
+import threading
+from functools import lru_cache
 import streamlit as st
-import requests
-from markdown import markdown
-import html
+import httpx
+import orjson
+
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:5000")
 
 # Streamlit page configuration
 st.set_page_config(page_title="Scholarship Finder", page_icon="🎓", layout="wide")
 
+# Long-lived event loop for backend calls; asyncio.run() would tie the pooled
+# client to a loop that is closed as soon as the first call returns
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="backend-io", daemon=True).start()
+    return loop
+
+# Pooled async HTTP client shared across reruns so the backend connection is kept alive
+@st.cache_resource
+def get_async_client():
+    # retries=3 re-attempts failed connects (e.g. while the backend restarts), like the
+    # requests adapter's Retry did for POSTs; pool settings live on the transport
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60)
+    )
+    return httpx.AsyncClient(
+        base_url=BACKEND_URL,
+        transport=transport,
+        timeout=httpx.Timeout(30, connect=3.05)  # Fail fast on connect, bound the read
+    )
+
+# Serialized request bodies for recent queries
+@lru_cache(maxsize=256)
+def _payload(query):
+    return orjson.dumps({"query": query})
+
+async def _fetch(client, query):
+    # Stream the body so the status is checked before anything is buffered and
+    # the payload is held once instead of as both bytes and decoded text
+    async with client.stream("POST", "/search", content=_payload(query), headers={"Content-Type": "application/json"}) as response:
+        response.raise_for_status()  # Raise an error for bad status codes (errors are not cached)
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+    return orjson.loads(body)
+
+# Cache backend responses so repeat searches skip the round trip
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def search_scholarships(query):
+    future = asyncio.run_coroutine_threadsafe(_fetch(get_async_client(), query), get_event_loop())
+    return future.result()
+
+# Results panel reruns on its own when the user interacts with it
+@st.fragment
+def render_results(data):
+    st.markdown(data["response"]["markdown"])
+
+    # Optionally display the extracted intent
+    with st.expander("View Intent Details"):
+        st.json(data["response"]["intent"])
+
+# The result on screen, as (normalized query, response); older results are not kept
+# here, repeat searches go through search_scholarships' bounded, expiring cache
+st.session_state.setdefault("current_result", None)
+
 # Title and description
 st.title("Scholarship Finder")
 st.markdown("Enter your scholarship query (e.g., 'Mumbai undergraduate scholarships 2025') to find relevant financial aid options.")
@@ -15,30 +78,42 @@ with st.form(key="search_form"):
     query = st.text_input("Search for scholarships:", placeholder="e.g., Mumbai undergraduate scholarships 2025")
     submit_button = st.form_submit_button(label="Search")
 
+# A retry click re-submits the query that timed out
+retry_query = st.session_state.pop("retry_query", None)
+if retry_query:
+    query = retry_query
+
 # Handle form submission
-if submit_button:
-    if not query.strip():
-        st.error("Please enter a valid query.")
+if submit_button or retry_query:
+    # Mirror the backend's minimum-length check so obvious non-queries never leave the browser
+    if len(query.strip()) < 3 or not any(c.isalnum() for c in query):
+        st.error("Please enter a valid query of at least 3 characters.")
     else:
-        with st.spinner("Searching for scholarships..."):
+        with st.status("Searching for scholarships...") as status:
             try:
-                # Send request to Flask backend
-                response = requests.post("http://localhost:5000/search", json={"query": query})
-                response.raise_for_status()  # Raise an error for bad status codes
-                data = response.json()
-
-                # Extract and render the markdown response
-                markdown_response = data["response"]["markdown"]
-                html_response = markdown(markdown_response)  # Convert markdown to HTML
-                st.markdown(html_response, unsafe_allow_html=True)  # Render HTML in Streamlit
+                # Normalize so near-repeat queries share a cache entry
+                normalized_query = " ".join(query.lower().split())
+                current = st.session_state["current_result"]
+                if current is None or current[0] != normalized_query:
+                    # Send request to Flask backend
+                    status.update(label="Contacting the scholarship backend...")
+                    st.session_state["current_result"] = (normalized_query, search_scholarships(normalized_query))
+                status.update(label="Results received", state="complete")
+            except httpx.TimeoutException:
+                status.update(label="Search timed out", state="error")
+                st.error("The backend took too long to respond. Please try again.")
+                st.button("Retry", on_click=st.session_state.update, kwargs={"retry_query": normalized_query})
+            except httpx.HTTPError as e:
+                status.update(label="Search failed", state="error")
+                st.error(f"Failed to fetch results: {str(e)}. Please ensure the backend is running and try again.")
 
-                # Optionally display the extracted intent
-                with st.expander("View Intent Details"):
-                    st.json(data["response"]["intent"])
+if st.session_state["current_result"] is not None:
+    render_results(st.session_state["current_result"][1])
 
-            except requests.exceptions.RequestException as e:
-                st.error(f"Failed to fetch results: {str(e)}. Please ensure the backend is running and try again.")
+# Footer (a fragment, so interactions elsewhere on the page don't re-send it)
+@st.fragment
+def footer():
+    st.markdown("---")
+    st.markdown("Powered by Streamlit | Backend by Flask | Data sourced via Google Custom Search API")
 
-# Footer
-st.markdown("---")
-st.markdown("Powered by Streamlit | Backend by Flask | Data sourced via Google Custom Search API")
\ No newline at end of file
+footer()
\ No newline at end of file
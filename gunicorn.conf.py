@@ -0,0 +1,27 @@
+import os
+import multiprocessing
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Chat requests spend most of their time waiting on Gemini, so run several
+# threaded workers instead of the single-threaded development server
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# Only used by async workers (gevent), which patch sockets themselves on startup
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Longer than the frontend's 60s keep-alive expiry so pooled connections
+# are closed by the client rather than reset by the server
+keepalive = 75
+timeout = 60
+
+def on_starting(server):
+    # Fetch the WordNet corpus once in the master, so workers never download it
+    # on a request thread (same as main.ensure_wordnet, without importing the app here)
+    import nltk
+    try:
+        nltk.data.find('corpora/wordnet')
+    except LookupError:
+        if not nltk.download('wordnet', quiet=True):
+            server.log.warning("WordNet download failed; answers will be cached without lemmatization")
@@ -1,38 +1,142 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import re
 import logging
-import uuid
-from flask import Flask, request, jsonify
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from operator import attrgetter
+from types import MappingProxyType
+from flask import Flask, Response, g, request, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-import json
+from sqlalchemy import event, insert, or_, select, update
+import orjson
 from datetime import datetime
-import nltk
-from nltk.stem import WordNetLemmatizer
+import semantic_cache
+
+# Naive datetimes in responses are UTC; orjson writes them as RFC 3339 with a Z suffix.
+# Non-string dict keys are stringified like the stdlib json module does instead of raising.
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, so request.get_json and any jsonify skip the stdlib json"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=str, option=ORJSON_OPTIONS), mimetype='application/json')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, supports_credentials=True)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'default-secret-key')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///scholarship_users.db'
+# DATABASE_URL lets production point at Postgres instead of the local SQLite file
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///scholarship_users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 GEMINI_API_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:generateContent'
+GEMINI_STREAM_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro:streamGenerateContent'
+
+# Shared HTTP session so all Gemini calls reuse pooled keep-alive connections
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=1,  # Pools are per host and Gemini is the only one
+    pool_maxsize=50,
+    # Retry connection failures and transient 429/5xx; once retries are used up the last
+    # response is returned so callers still see Gemini's own status and message.
+    # read=0: a read timeout is not retried, so a call stays within its own timeout
+    max_retries=Retry(
+        total=2,
+        read=0,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({'POST'}),
+        raise_on_status=False
+    )
+)
+_session.mount('https://', _adapter)
+# Every Gemini call sends a pre-encoded JSON body
+_session.headers.update({'Content-Type': 'application/json'})
+
+def get_session():
+    return _session
+
+# Runs Gemini answer calls so the profile write can proceed on the request thread meanwhile
+_gemini_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('GEMINI_WORKERS', 16)),
+    thread_name_prefix='gemini'
+)
+# Overall wait for an answer call, kept below gunicorn's 60s worker timeout
+GEMINI_ANSWER_TIMEOUT = 45  # seconds
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Debug output is opt-in (LOG_LEVEL=DEBUG); it logs full queries and profile rows.
+# Request threads only enqueue records; a listener thread does the formatting and stream I/O.
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_enqueue = QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter('%(message)s'))  # Merge args only; the listener adds the prefix
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), handlers=[_log_enqueue])
+_log_listener = QueueListener(_log_queue, _log_stream, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
-# Download NLTK data
-try:
-    nltk.data.find('corpora/wordnet')
-except LookupError:
-    nltk.download('wordnet')
+# Lemmatizer is created on first use so NLTK and WordNet stay off the import path.
+# The corpus is downloaded at startup (ensure_wordnet below, or gunicorn's on_starting hook),
+# never on a request thread.
+_lemmatizer = None
+_lemmatizer_failed = False  # Loading is attempted once; later calls fail fast without taking the lock
+_lemmatizer_lock = threading.Lock()
 
-# Initialize lemmatizer
-lemmatizer = WordNetLemmatizer()
+def ensure_wordnet():
+    """Download the WordNet corpus unless it is already installed; False if the download failed"""
+    import nltk
+    try:
+        nltk.data.find('corpora/wordnet')
+    except LookupError:
+        return nltk.download('wordnet', quiet=True)
+    return True
+
+def _get_lemmatizer():
+    """Shared WordNet lemmatizer; raises LookupError when the corpus can't be loaded"""
+    global _lemmatizer, _lemmatizer_failed
+    if _lemmatizer is None:
+        if _lemmatizer_failed:
+            raise LookupError("WordNet lemmatizer unavailable")
+        with _lemmatizer_lock:
+            if _lemmatizer is None:
+                if _lemmatizer_failed:
+                    raise LookupError("WordNet lemmatizer unavailable")
+                try:
+                    from nltk.stem import WordNetLemmatizer
+
+                    lemmatizer = WordNetLemmatizer()
+                    lemmatizer.lemmatize('scholarships')  # Load the corpus while holding the lock
+                except (LookupError, OSError) as e:
+                    _lemmatizer_failed = True
+                    logger.error(f"WordNet lemmatizer unavailable, not retrying: {str(e)}")
+                    raise LookupError("WordNet lemmatizer unavailable") from e
+                _lemmatizer = lemmatizer
+    return _lemmatizer
 
 # Database Model for User Details
 class UserDetails(db.Model):
@@ -54,9 +158,67 @@ class UserDetails(db.Model):
     def __repr__(self):
         return f"<UserDetails {self.id}>"
 
-# Create database tables
+# Profile columns filled from user queries, and a getter that reads them all in one call
+USER_FIELDS = (
+    'caste', 'income', 'gender', 'course_level', 'is_hostel', 'cgpa',
+    'is_minority', 'has_disability', 'ex_serviceman_parent', 'scholarship_type'
+)
+_get_user_fields = attrgetter(*USER_FIELDS)
+
+# The current profile is always looked up as the most recent row
+db.Index('ix_user_details_timestamp', UserDetails.timestamp.desc())
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the per-turn profile reads proceed while another worker is writing
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')  # Read pages through a 256 MB memory map
+    cursor.close()
+
+# Create database tables (and indexes missing from databases created before them)
 with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', _set_sqlite_pragmas)
     db.create_all()
+    for index in UserDetails.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+# Read-only snapshot of the most recent row. The app treats that row as "the user", so the
+# snapshot is shared by all requests in this process and replaced whenever we write it.
+# RECENT_USER_TTL bounds how long a write made by another worker process can go unseen:
+# the TTL runs from the last database read, and local writes don't extend it.
+RecentUser = namedtuple('RecentUser', ('id', 'query', 'intent', 'timestamp') + USER_FIELDS)
+RECENT_USER_TTL = float(os.environ.get('RECENT_USER_TTL', 10))  # seconds
+_recent_user = None  # (expires_at, RecentUser or None)
+
+def _snapshot(row):
+    return RecentUser._make(getattr(row, field) for field in RecentUser._fields) if row else None
+
+def set_recent_user(snapshot, loaded=False):
+    """Replace the snapshot; only a fresh database read (loaded=True) restarts the TTL"""
+    global _recent_user
+    cached = _recent_user
+    expires_at = time.monotonic() + RECENT_USER_TTL if loaded or cached is None else cached[0]
+    _recent_user = (expires_at, snapshot)
+    g.recent_user = snapshot
+
+def get_recent_user():
+    """Most recently updated user profile; hits the database at most once per RECENT_USER_TTL"""
+    if 'recent_user' not in g:
+        cached = _recent_user
+        if cached is not None and cached[0] > time.monotonic():
+            g.recent_user = cached[1]
+        else:
+            # Always look up the newest row (served by ix_user_details_timestamp): concurrent
+            # first turns in different workers can each insert a row, so the id held here
+            # is not necessarily the current one
+            row = db.session.execute(
+                select(UserDetails).order_by(UserDetails.timestamp.desc()).limit(1)
+            ).scalar_one_or_none()
+            set_recent_user(_snapshot(row), loaded=True)
+    return g.recent_user
 
 # List of fallback questions
 FALLBACK_QUESTIONS = [
@@ -72,24 +234,128 @@ FALLBACK_QUESTIONS = [
     "Would you like information about government, private, NGO, or college-specific scholarships?"
 ]
 
+# Intents the classifier may return (tuple keeps prompt order, frozenset for lookups)
+POSSIBLE_INTENTS = (
+    'greeting',
+    'bot_info',
+    'bot_functionality',
+    'casual',
+    'scholarship_query',
+    'scholarship_personalized',
+    'scholarship_types',
+    'scholarship_type_selection',
+    'general_conversation'
+)
+_POSSIBLE_INTENTS_SET = frozenset(POSSIBLE_INTENTS)
+
+# Compact listing format the answer prompts ask Gemini to follow
+SCHOLARSHIP_FORMAT = """🎓 **[Scholarship Name]**  
+**Level:** [UG / PG / Both]  
+**Category:** [SC / ST / OBC / General / Minority / Girls]  
+**Description:** [Short 1-line purpose of scholarship]  
+**Portal:** [Application or Info URL]"""
+
+# Exact-match cache of successful Gemini query analyses (intent + details), keyed on
+# the normalized input. Failed calls are never cached so they are retried next time.
+GEMINI_CACHE_TTL = int(os.environ.get('GEMINI_CACHE_TTL', 3600))  # seconds
+GEMINI_CACHE_SIZE = 4096
+_turn_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return value
+
+def _cache_put(cache, key, value):
+    with _cache_lock:
+        cache[key] = (time.monotonic() + GEMINI_CACHE_TTL, value)
+        cache.move_to_end(key)
+        if len(cache) > GEMINI_CACHE_SIZE:
+            cache.popitem(last=False)
+
+# Instructions to ensure chatbot knows answers to fallback questions. Sent as the
+# system instruction of the answer call so the constant prefix stays out of the prompt
+CHAT_SYSTEM_INSTRUCTION = """IMPORTANT INSTRUCTIONS FOR THE CHATBOT:
+1. You MUST maintain the response structure: 
+   - First provide scholarship information based on known user details
+   - Then ask ONE relevant follow-up question at the end
+
+2. For follow-up questions:
+   - If user hasn't provided key details (caste, income, etc.), ask for those
+   - If all details are provided, ask if they want application process info
+   - Keep questions simple and one at a time
+
+3. You MUST know the answers to your own follow-up questions. For example:
+   - If asking about caste, be ready to explain different categories
+   - If asking about application process, be ready to guide them
+   - If asking about income, know the typical ranges
+
+4. Always end with a question to keep the conversation flowing.
+"""
+
+# Canned replies for intents that don't need a Gemini generation
+CANNED_RESPONSES = {
+    'greeting': [
+        "Hi! I'm here to help with Maharashtra scholarships. What are you looking for today?",
+        "Hello! I'm your Maharashtra scholarship assistant. How can I help you find financial aid?",
+        "Hey there! I can help you find government, private, NGO, and college scholarships in Maharashtra. What's up?",
+        "Namaste! I help students discover Maharashtra scholarships. What would you like to know?",
+        "Hi! Looking for a scholarship? Tell me a bit about yourself and I'll find options for you. Where shall we start?"
+    ],
+    'casual': [
+        "Thanks! Need any help with scholarships?",
+        "Glad to help! Is there anything else you'd like to know about scholarships?",
+        "Sure! Would you like me to look up more scholarships for you?",
+        "You're welcome! Shall we explore government, private, NGO, or college scholarships next?",
+        "Happy to help! Anything else about Maharashtra scholarships I can check for you?"
+    ],
+    'bot_info': [
+        "I can:\n• Find government, private, NGO, and college scholarships in Maharashtra\n• Guide you on applications and eligibility\n• Share tips to avoid common mistakes\n\nWhat scholarship info do you need?",
+        "I'm a Maharashtra scholarship assistant. I match your details (category, income, course) to relevant scholarships, explain eligibility, and walk you through applying on portals like MahaDBT and NSP.\n\nWhat scholarship info do you need?"
+    ]
+}
+
+@lru_cache(maxsize=50000)
+def _lemma(word):
+    return _get_lemmatizer().lemmatize(word)
+
+# Chat queries repeat a lot, so whole lemmatized queries are memoized as well
+@lru_cache(maxsize=8192)
 def lemmatize_text(text):
-    words = text.split()
-    return ' '.join(lemmatizer.lemmatize(word) for word in words)
+    return ' '.join(map(_lemma, text.split()))
 
-def extract_user_details_with_gemini(user_input):
-    """
-    Use Gemini API to extract user details from the input.
-    Returns a dictionary with extracted fields.
-    """
-    if not GEMINI_API_KEY:
-        logger.error("GEMINI_API_KEY not configured")
-        return {}
-    
-    prompt = f"""
-Analyze the following user query about scholarships and extract relevant details in JSON format.
-Return ONLY the JSON object with the extracted fields, nothing else.
+def cache_query_for(user_input):
+    """Semantic cache key text for a query; unlemmatized when WordNet isn't available"""
+    text = user_input.lower()
+    try:
+        return lemmatize_text(text)
+    except (LookupError, OSError):
+        return text
 
-Fields to extract:
+# Static classification instructions, sent as systemInstruction so each call only carries the query
+CLASSIFY_SYSTEM_INSTRUCTION = f"""Analyze the user query about scholarships. Classify it into one intent and extract relevant details.
+Respond with a JSON object of the form {{"intent": "<intent>", "details": {{...}}}}.
+
+Intents: {', '.join(POSSIBLE_INTENTS)}
+- greeting: User says hi, hello, or similar greetings.
+- bot_info: User asks about what the bot can do or its capabilities.
+- bot_functionality: User asks how the bot works or how to use it.
+- casual: User makes casual remarks like "thanks", "okay", or small talk.
+- scholarship_query: User asks general questions about scholarships or financial aid.
+- scholarship_personalized: User provides personal details (e.g., caste, income, course) to find specific scholarships.
+- scholarship_types: User asks about types or categories of scholarships.
+- scholarship_type_selection: User explicitly selects a scholarship type (e.g., government, private, ngo, college).
+- general_conversation: Any other input that doesn't fit the above categories.
+
+Details to extract (omit or use null when not mentioned):
 - caste: SC, ST, OBC, General, Minority (or null if not mentioned)
 - income: Annual family income if mentioned (e.g., "1.5 lakh", "below 2.5L")
 - gender: male, female (or null if not mentioned)
@@ -103,240 +369,201 @@ Fields to extract:
 
 Example output for "I'm an SC girl with 1.5L income looking for government scholarships":
 {{
-  "caste": "sc",
-  "income": "1.5 lakh",
-  "gender": "female",
-  "scholarship_type": "government"
+  "intent": "scholarship_personalized",
+  "details": {{
+    "caste": "sc",
+    "income": "1.5 lakh",
+    "gender": "female",
+    "scholarship_type": "government"
+  }}
 }}
-
-Now analyze this query:
-"{user_input}"
 """
 
-    headers = {'Content-Type': 'application/json'}
-    data = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "generationConfig": {
-            "temperature": 0.3,
-            "topK": 1,
-            "topP": 1.0,
-            "maxOutputTokens": 500,
+def _nullable(type_, **extra):
+    return {"type": type_, "nullable": True, **extra}
+
+# Structured output schema for the classification call, so Gemini returns bare JSON
+CLASSIFY_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "intent": {"type": "STRING", "enum": list(POSSIBLE_INTENTS)},
+        "details": {
+            "type": "OBJECT",
+            "properties": {
+                "caste": _nullable("STRING"),
+                "income": _nullable("STRING"),
+                "gender": _nullable("STRING", enum=["male", "female"]),
+                "course_level": _nullable("STRING", enum=["ug", "pg"]),
+                "is_hostel": _nullable("BOOLEAN"),
+                "cgpa": _nullable("NUMBER"),
+                "is_minority": _nullable("BOOLEAN"),
+                "has_disability": _nullable("BOOLEAN"),
+                "ex_serviceman_parent": _nullable("BOOLEAN"),
+                "scholarship_type": _nullable("STRING", enum=["government", "private", "ngo", "college"])
+            }
         }
-    }
-    params = {'key': GEMINI_API_KEY}
-
-    try:
-        response = requests.post(
-            GEMINI_API_URL,
-            headers=headers,
-            params=params,
-            json=data,
-            timeout=10
-        )
-
-        if response.status_code == 200:
-            content = response.json()
-            if 'candidates' in content and len(content['candidates']) > 0:
-                response_text = content['candidates'][0]['content']['parts'][0]['text'].strip()
-                try:
-                    # Extract JSON from the response
-                    json_start = response_text.find('{')
-                    json_end = response_text.rfind('}') + 1
-                    json_str = response_text[json_start:json_end]
-                    extracted_data = json.loads(json_str)
-                    logger.debug(f"Extracted details from Gemini: {extracted_data}")
-                    return extracted_data
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse Gemini response as JSON: {response_text}")
-                    return {}
-            else:
-                logger.error("No response from Gemini API for entity extraction")
-                return {}
-        else:
-            error_message = f'Gemini API error: {response.status_code}'
-            try:
-                error_detail = response.json()
-                if 'error' in error_detail:
-                    error_message += f" - {error_detail['error'].get('message', 'Unknown error')}"
-            except:
-                error_message += f" - {response.text[:200]}"
-            logger.error(error_message)
-            return {}
-    except requests.exceptions.Timeout:
-        logger.error("Gemini API request timeout for entity extraction")
-        return {}
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error during entity extraction: {str(e)}")
-        return {}
-    except Exception as e:
-        logger.error(f"Unexpected error during entity extraction: {str(e)}")
-        return {}
-
-def analyze_query_type(user_input):
+    },
+    "required": ["intent", "details"]
+}
+
+# Short inputs that can be classified locally without a Gemini round trip.
+# One alternation with a named group per intent, so each input is matched in a single pass.
+_LOCAL_INTENT_RE = re.compile(
+    r'(?:(?P<greeting>(?:hi+|hello|hey|namaste|good (?:morning|afternoon|evening))(?: there)?)'
+    r'|(?P<casual>thanks|thank you|thx|ok|okay|bye|cool|great|nice)'
+    r'|(?P<scholarship_type>government|private|ngo|college)(?: scholarships?)?)'
+    r'[\s!.]*'
+)
+
+# The most frequent exact inputs, answered with a dict lookup before trying the regex
+TRIVIAL_INTENTS = {
+    'hello': ('greeting', None), 'hey': ('greeting', None), 'namaste': ('greeting', None),
+    'thanks': ('casual', None), 'thank you': ('casual', None), 'okay': ('casual', None),
+    'bye': ('casual', None), 'cool': ('casual', None),
+    'government': ('scholarship_type_selection', 'government'),
+    'private': ('scholarship_type_selection', 'private'),
+    'ngo': ('scholarship_type_selection', 'ngo'),
+    'college': ('scholarship_type_selection', 'college')
+}
+
+def classify_locally(text):
+    """Return (intent, details) for unambiguous short inputs, or None to ask Gemini"""
+    trivial = TRIVIAL_INTENTS.get(text)
+    if trivial is not None:
+        intent, scholarship_type = trivial
+        return intent, {'scholarship_type': scholarship_type} if scholarship_type else {}
+    
+    match = _LOCAL_INTENT_RE.fullmatch(text)
+    if not match:
+        return None
+    if match.group('greeting'):
+        return 'greeting', {}
+    if match.group('casual'):
+        return 'casual', {}
+    return 'scholarship_type_selection', {'scholarship_type': match.group('scholarship_type')}
+
+def classify_and_extract(user_input):
     """
-    Use Gemini API to classify the user input into one of the predefined intents.
+    Use a single Gemini API call to classify the user input into one of the
+    predefined intents and extract user details from it.
+    Returns an (intent, details) tuple; falls back to ('general_conversation', {}).
     """
-    user_input_lower = user_input.lower().strip()
-    logger.debug(f"Analyzing query type for input: {user_input_lower} using Gemini API")
-
-    if not GEMINI_API_KEY:
-        logger.error("GEMINI_API_KEY not configured")
-        return 'general_conversation'  # Fallback intent
-
-    # Define the possible intents
-    possible_intents = [
-        'greeting',
-        'bot_info',
-        'bot_functionality',
-        'casual',
-        'scholarship_query',
-        'scholarship_personalized',
-        'scholarship_types',
-        'scholarship_type_selection',
-        'general_conversation'
-    ]
+    cache_key = user_input.lower().strip()
+    local = classify_locally(cache_key)
+    if local is not None:
+        logger.debug("Classified input locally: %s: %s", cache_key, local[0])
+        return local
 
-    # Create prompt for Gemini API to classify intent
-    prompt = f"""
-Classify the following user input into one of these intents: {', '.join(possible_intents)}.
-Return only the intent name, nothing else.
+    cached = _cache_get(_turn_cache, cache_key)
+    if cached is not None:
+        intent, details = cached
+        logger.debug("Using cached analysis for input: %s: %s", cache_key, intent)
+        return intent, dict(details)  # Callers mutate the details, so hand out a copy
 
-Input: "{user_input_lower}"
+    logger.debug("Analyzing input: %s using Gemini API", cache_key)
 
-Intent descriptions for reference:
-- greeting: User says hi, hello, or similar greetings.
-- bot_info: User asks about what the bot can do or its capabilities.
-- bot_functionality: User asks how the bot works or how to use it.
-- casual: User makes casual remarks like "thanks", "okay", or small talk.
-- scholarship_query: User asks general questions about scholarships or financial aid.
-- scholarship_personalized: User provides personal details (e.g., caste, income, course) to find specific scholarships.
-- scholarship_types: User asks about types or categories of scholarships.
-- scholarship_type_selection: User explicitly selects a scholarship type (e.g., government, private, ngo, college).
-- general_conversation: Any other input that doesn't fit the above categories.
-"""
+    if not GEMINI_API_KEY:
+        logger.error("GEMINI_API_KEY not configured")
+        return 'general_conversation', {}  # Fallback intent
 
-    headers = {'Content-Type': 'application/json'}
     data = {
-        "contents": [{"parts": [{"text": prompt}]}],
+        "systemInstruction": {"parts": [{"text": CLASSIFY_SYSTEM_INSTRUCTION}]},
+        "contents": [{"parts": [{"text": user_input}]}],
         "generationConfig": {
             "temperature": 0.3,
             "topK": 1,
             "topP": 1.0,
-            "maxOutputTokens": 50,
+            "maxOutputTokens": 256,
+            "responseMimeType": "application/json",
+            "responseSchema": CLASSIFY_RESPONSE_SCHEMA
         }
     }
     params = {'key': GEMINI_API_KEY}
 
     try:
-        response = requests.post(
+        response = get_session().post(
             GEMINI_API_URL,
-            headers=headers,
             params=params,
-            json=data,
+            data=orjson.dumps(data),
             timeout=10
         )
 
         if response.status_code == 200:
-            content = response.json()
+            content = orjson.loads(response.content)
             if 'candidates' in content and len(content['candidates']) > 0:
-                intent = content['candidates'][0]['content']['parts'][0]['text'].strip()
-                if intent in possible_intents:
-                    logger.debug(f"Gemini API detected intent: {intent}")
-                    return intent
-                else:
+                # JSON mode: the part text is the analysis object itself
+                analysis = orjson.loads(content['candidates'][0]['content']['parts'][0]['text'])
+                intent = analysis.get('intent')
+                details = analysis.get('details') or {}
+                # Nullable schema fields come back as explicit nulls; drop them so
+                # "not mentioned" looks the same as before JSON mode (key absent)
+                details = {k: v for k, v in details.items() if v is not None} if isinstance(details, dict) else {}
+                if intent not in _POSSIBLE_INTENTS_SET:
                     logger.warning(f"Gemini API returned invalid intent: {intent}. Falling back to general_conversation")
-                    return 'general_conversation'
+                    return 'general_conversation', details
+
+                logger.debug("Gemini API detected intent: %s, details: %s", intent, details)
+                _cache_put(_turn_cache, cache_key, (intent, tuple(details.items())))
+                return intent, details
             else:
-                logger.error("No response from Gemini API for intent detection")
-                return 'general_conversation'
+                logger.error("No response from Gemini API for query analysis")
+                return 'general_conversation', {}
         else:
             error_message = f'Gemini API error: {response.status_code}'
             try:
-                error_detail = response.json()
+                error_detail = orjson.loads(response.content)
                 if 'error' in error_detail:
                     error_message += f" - {error_detail['error'].get('message', 'Unknown error')}"
-            except:
-                error_message += f" - {response.text[:200]}"
+            except (orjson.JSONDecodeError, TypeError, AttributeError):
+                error_message += f" - {response.content[:200].decode('utf-8', 'replace')}"
             logger.error(error_message)
-            return 'general_conversation'
+            return 'general_conversation', {}
 
     except requests.exceptions.Timeout:
-        logger.error("Gemini API request timeout for intent detection")
-        return 'general_conversation'
+        logger.error("Gemini API request timeout for query analysis")
+        return 'general_conversation', {}
     except requests.exceptions.RequestException as e:
-        logger.error(f"Network error during intent detection: {str(e)}")
-        return 'general_conversation'
+        logger.error(f"Network error during query analysis: {str(e)}")
+        return 'general_conversation', {}
     except Exception as e:
-        logger.error(f"Unexpected error during intent detection: {str(e)}")
-        return 'general_conversation'
+        logger.error(f"Unexpected error during query analysis: {str(e)}")
+        return 'general_conversation', {}
+
+# Profile fields the bot asks about when they are still unknown
+IMPORTANT_FIELDS = (
+    'caste', 'income', 'gender', 'course_level',
+    'is_hostel', 'cgpa', 'is_minority',
+    'has_disability', 'ex_serviceman_parent'
+)
+
+# Follow-up question per missing field, in the order they should be asked
+_FIELD_TO_QUESTION = (
+    ('caste', FALLBACK_QUESTIONS[1]),
+    ('income', FALLBACK_QUESTIONS[2]),
+    ('gender', FALLBACK_QUESTIONS[3]),
+    ('is_hostel', FALLBACK_QUESTIONS[4]),
+    ('cgpa', FALLBACK_QUESTIONS[5]),
+    ('is_minority', FALLBACK_QUESTIONS[6]),
+    ('has_disability', FALLBACK_QUESTIONS[7]),
+    ('ex_serviceman_parent', FALLBACK_QUESTIONS[8])
+)
 
 def get_missing_details(user_details):
     """Determine which important details are missing from user profile"""
-    important_fields = [
-        'caste', 'income', 'gender', 'course_level',
-        'is_hostel', 'cgpa', 'is_minority',
-        'has_disability', 'ex_serviceman_parent'
-    ]
-    
-    missing = []
-    for field in important_fields:
-        if not user_details.get(field):
-            missing.append(field)
-    return missing
+    return {field for field in IMPORTANT_FIELDS if not user_details.get(field)}
 
 def create_fallback_question(missing_fields):
     """Create appropriate follow-up question based on missing fields"""
     if not missing_fields:
         return FALLBACK_QUESTIONS[0]  # Default question about application process
     
-    # Prioritize certain questions
-    if 'caste' in missing_fields:
-        return FALLBACK_QUESTIONS[1]
-    if 'income' in missing_fields:
-        return FALLBACK_QUESTIONS[2]
-    if 'gender' in missing_fields:
-        return FALLBACK_QUESTIONS[3]
-    if 'is_hostel' in missing_fields:
-        return FALLBACK_QUESTIONS[4]
-    if 'cgpa' in missing_fields:
-        return FALLBACK_QUESTIONS[5]
-    if 'is_minority' in missing_fields:
-        return FALLBACK_QUESTIONS[6]
-    if 'has_disability' in missing_fields:
-        return FALLBACK_QUESTIONS[7]
-    if 'ex_serviceman_parent' in missing_fields:
-        return FALLBACK_QUESTIONS[8]
+    for field, question in _FIELD_TO_QUESTION:
+        if field in missing_fields:
+            return question
     
     return FALLBACK_QUESTIONS[-1]  # Generic scholarship type question
 
-def create_scholarship_prompt(user_input, user_details=None):
-    query_type = analyze_query_type(user_input)
-    logger.debug(f"Creating prompt for query type: {query_type}")
-    
-    recent_user = db.session.query(UserDetails).order_by(UserDetails.timestamp.desc()).first()
-    stored_scholarship_type = recent_user.scholarship_type if recent_user and recent_user.scholarship_type != 'unspecified' else None
-    stored_details = {}
-    if recent_user:
-        stored_details = {
-            'caste': recent_user.caste,
-            'income': recent_user.income,
-            'gender': recent_user.gender,
-            'course_level': recent_user.course_level,
-            'is_hostel': recent_user.is_hostel,
-            'cgpa': recent_user.cgpa,
-            'is_minority': recent_user.is_minority,
-            'has_disability': recent_user.has_disability,
-            'ex_serviceman_parent': recent_user.ex_serviceman_parent,
-            'scholarship_type': stored_scholarship_type
-        }
-    
-    # Determine missing details for fallback question
-    current_details = user_details or {}
-    combined_details = {**stored_details, **current_details}
-    missing_details = get_missing_details(combined_details)
-    fallback_question = create_fallback_question(missing_details)
-    
-    common_mistakes = """
+COMMON_MISTAKES = """
 💡 **Avoid these mistakes:**
 📄 Missing/blurry/expired documents
 📅 Applying late, wrong year
@@ -345,52 +572,71 @@ def create_scholarship_prompt(user_input, user_details=None):
 🏦 Inactive/wrong bank details
 📱 Wrong mobile/email, lost ID
 """
-    
-    if query_type == 'greeting':
-        return f"""
-User greeted: "{user_input}". Respond warmly, introduce as Maharashtra scholarship assistant.
-Example: "Hi! I'm here to help with Maharashtra scholarships. What's up?"
-"""
-    
-    elif query_type == 'bot_info':
-        return f"""
-User asked: "{user_input}". Explain capabilities:
-- Find government, private, NGO, college scholarships
-- Guide on applications, eligibility
-- Share tips
-Ask: "What scholarship info do you need?"
-"""
-    
-    elif query_type == 'bot_functionality':
-        return f"""
+
+# Prompt templates for intents that only need the query and the fallback question
+# (greeting, bot_info and casual are answered from CANNED_RESPONSES and never get a prompt)
+_TEMPLATES = {
+    'bot_functionality': """
 User asked: "{user_input}". Explain:
 - Match details to government, private, NGO, college scholarships
 - Use portals like MahaDBT (https://mahadbtmahait.gov.in/), NSP (https://scholarships.gov.in/)
 - Guide applications
 Ask: "Which scholarship type interests you?"
-"""
-    
-    elif query_type == 'casual':
-        return f"""
-User said: "{user_input}". Respond naturally, guide to scholarships if relevant.
-Example: "Thanks! Need scholarship help?"
-"""
-    
-    elif query_type == 'general_conversation':
-        return f"""
+""",
+    'general_conversation': """
 User said: "{user_input}". Redirect to scholarship types.
 Example: "I focus on Maharashtra scholarships (government, private, NGO, college). Which type are you looking for?"
 {common_mistakes}
+""",
+    'scholarship_types': """
+User asked: "{user_input}" about types of scholarships.
+Your task is to:
+1. List the main types of scholarships available in Maharashtra with brief descriptions:
+   - Government: Funded by state or central government, e.g., via MahaDBT (https://mahadbtmahait.gov.in/)
+   - Private: Offered by private organizations, e.g., via Buddy4Study (https://buddy4study.com/)
+   - NGO: Provided by non-profits, often listed on Buddy4Study
+   - College/University: Institution-specific, e.g., Mumbai University (https://mu.ac.in/)
+2. Ask: "Which type of scholarship are you looking for? (e.g., Government, Private, NGO, College)"
+
+End with:
+{common_mistakes}
+
+{fallback_question}
 """
-    
-    elif query_type == 'scholarship_query':
-        if stored_scholarship_type:
-            details_str = "\n🤖 What the chatbot knows about the user:\n"
-            for key, value in stored_details.items():
-                if value is not None and key != 'scholarship_type':
-                    details_str += f"- {key.replace('_', ' ').title()}: {value}\n"
-            details_str += f"- Scholarship Type: {stored_scholarship_type.capitalize()}\n"
-            return f"""
+}
+
+_DEFAULT_TEMPLATE = """
+Unhandled intent: {query_type}. Redirect to scholarship help.
+Example: "I'm here for Maharashtra scholarships (government, private, NGO, college). Which type are you looking for?"
+{common_mistakes}
+
+{fallback_question}
+"""
+
+def _render_template(template):
+    def render(user_input, query_type, user_details, stored_details, fallback_question):
+        return template.format_map({
+            'user_input': user_input,
+            'query_type': query_type,
+            'fallback_question': fallback_question,
+            'common_mistakes': COMMON_MISTAKES
+        })
+    return render
+
+def _details_lines(details, skip=None):
+    """Markdown list of the known (non-None) profile fields, one "- Field Name: value" line each"""
+    return ''.join(
+        f"- {key.replace('_', ' ').title()}: {value}\n"
+        for key, value in details.items()
+        if value is not None and key != skip
+    )
+
+def _render_scholarship_query(user_input, query_type, user_details, stored_details, fallback_question):
+    stored_scholarship_type = stored_details.get('scholarship_type')
+    if stored_scholarship_type:
+        details_str = "\n🤖 What the chatbot knows about the user:\n" + _details_lines(stored_details, skip='scholarship_type')
+        details_str += f"- Scholarship Type: {stored_scholarship_type.capitalize()}\n"
+        return f"""
 The user said: "{user_input}"  
 Scholarship type stored: **{stored_scholarship_type.capitalize()}**  
 📌 Mention all details which you know about user:
@@ -400,11 +646,7 @@ Scholarship type stored: **{stored_scholarship_type.capitalize()}**
 
 1. List 4–5 relevant **scholarships in Maharashtra** for the `{stored_scholarship_type}` category in this compact format:
 
-🎓 **[Scholarship Name]**  
-**Level:** [UG / PG / Both]  
-**Category:** [SC / ST / OBC / General / Minority / Girls]  
-**Description:** [Short 1-line purpose of scholarship]  
-**Portal:** [Application or Info URL]
+{SCHOLARSHIP_FORMAT}
 
 2. Match scholarships to the user profile (caste, income, level, etc. if available).
 3. End with: _"Would you like more details on any of these scholarships or help with the application process?"_
@@ -415,11 +657,11 @@ Scholarship type stored: **{stored_scholarship_type.capitalize()}**
 - NGO: ONGC Foundation, KC Mahindra Scholarship  
 - College: Mumbai University Merit Scholarship, Pune University Endowment
 
-{common_mistakes}
+{COMMON_MISTAKES}
 
 {fallback_question}
 """
-        return f"""
+    return f"""
 The user said: "{user_input}"  
 ❗ No scholarship type is currently stored.
 
@@ -433,25 +675,23 @@ The user said: "{user_input}"
 
 2. Ask: _"Which type of scholarship are you looking for? (e.g., Government, Private, NGO, College)"_
 
-{common_mistakes}
+{COMMON_MISTAKES}
 
 {fallback_question}
 """
+
+def _render_scholarship_personalized(user_input, query_type, user_details, stored_details, fallback_question):
+    stored_scholarship_type = stored_details.get('scholarship_type')
+    details_str = ""
+    if user_details:
+        details_str += "\n📌 User profile based on current input:\n" + _details_lines(user_details)
     
-    elif query_type == 'scholarship_personalized':
-        details_str = ""
-        if user_details:
-            details_str += "\n📌 User profile based on current input:\n"
-            for key, value in user_details.items():
-                if value is not None:
-                    details_str += f"- {key.replace('_', ' ').title()}: {value}\n"
-        
-        if stored_scholarship_type:
-            if not user_details or 'scholarship_type' not in user_details or user_details['scholarship_type'] is None:
-                user_details = user_details or {}
-                user_details['scholarship_type'] = stored_scholarship_type
-            details_str += f"\n📦 Scholarship type from memory: **{stored_scholarship_type.capitalize()}**\n"
-            return f"""
+    if stored_scholarship_type:
+        if not user_details or 'scholarship_type' not in user_details or user_details['scholarship_type'] is None:
+            user_details = user_details or {}
+            user_details['scholarship_type'] = stored_scholarship_type
+        details_str += f"\n📦 Scholarship type from memory: **{stored_scholarship_type.capitalize()}**\n"
+        return f"""
 The user said: "{user_input}"  
 📌 Mention all details which you know about user:
 {details_str}
@@ -460,11 +700,7 @@ The user said: "{user_input}"
 
 1. Suggest 4–5 relevant **scholarships in Maharashtra** matching the user's `{stored_scholarship_type}` category and profile:
 
-🎓 **[Scholarship Name]**  
-**Level:** [UG / PG / Both]  
-**Category:** [SC / ST / OBC / General / Minority / Girls]  
-**Description:** [Short 1-line purpose of scholarship]  
-**Portal:** [Application or Info URL]
+{SCHOLARSHIP_FORMAT}
 
 2. Ensure matches based on caste, income, academic level, etc.
 3. End with: _"Would you like more details on any of these scholarships or help with the application process?"_
@@ -475,11 +711,11 @@ The user said: "{user_input}"
 - NGO: ONGC, KC Mahindra  
 - College: University-based
 
-{common_mistakes}
+{COMMON_MISTAKES}
 
 {fallback_question}
 """
-        return f"""
+    return f"""
 The user said: "{user_input}"  
 Here is what the chatbot knows based on this query:  
 {details_str}  
@@ -495,71 +731,46 @@ Here is what the chatbot knows based on this query:
 
 2. Ask: _"Which type of scholarship are you looking for? (e.g., Government, Private, NGO, College)"_
 
-{common_mistakes}
+{COMMON_MISTAKES}
 
 {fallback_question}
 """
-    
-    elif query_type == 'scholarship_types':
-        return f"""
-User asked: "{user_input}" about types of scholarships.
-Your task is to:
-1. List the main types of scholarships available in Maharashtra with brief descriptions:
-   - Government: Funded by state or central government, e.g., via MahaDBT (https://mahadbtmahait.gov.in/)
-   - Private: Offered by private organizations, e.g., via Buddy4Study (https://buddy4study.com/)
-   - NGO: Provided by non-profits, often listed on Buddy4Study
-   - College/University: Institution-specific, e.g., Mumbai University (https://mu.ac.in/)
-2. Ask: "Which type of scholarship are you looking for? (e.g., Government, Private, NGO, College)"
-
-End with:
-{common_mistakes}
 
-{fallback_question}
-"""
+def _render_scholarship_type_selection(user_input, query_type, user_details, stored_details, fallback_question):
+    scholarship_type = user_details.get('scholarship_type', 'unspecified') if user_details else 'unspecified'
+    summary = "Based on our conversation, here's what I know about you: "
+    known_details = []
     
-    elif query_type == 'scholarship_type_selection':
-        scholarship_type = user_details.get('scholarship_type', 'unspecified') if user_details else 'unspecified'
-        summary = "Based on our conversation, here's what I know about you: "
-        known_details = []
-        
-        if recent_user:
-            if recent_user.course_level:
-                course = 'BSc Computer Science' if recent_user.course_level == 'ug' and 'bsc' in user_input.lower() else 'Postgraduate'
-                known_details.append(f"you are a {course} student")
-            if recent_user.caste:
-                known_details.append(f"your category is {recent_user.caste.upper()}")
-            if recent_user.income:
-                known_details.append(f"your family income is {recent_user.income}")
-            if recent_user.gender:
-                known_details.append(f"you are a {recent_user.gender} student")
-        
-        if scholarship_type != 'unspecified':
-            known_details.append(f"you are looking for {scholarship_type} scholarships")
-        
-        if known_details:
-            summary += ", ".join(known_details) + "."
-        else:
-            summary = f"I know you're looking for {scholarship_type} scholarships."
-        
-        details_str = ""
-        if user_details:
-            details_str = "\nUser profile from current query:\n"
-            for key, value in user_details.items():
-                if value is not None:
-                    details_str += f"- {key.replace('_', ' ').title()}: {value}\n"
-        
-        return f"""
+    if stored_details.get('course_level'):
+        course = 'BSc Computer Science' if stored_details['course_level'] == 'ug' and 'bsc' in user_input.lower() else 'Postgraduate'
+        known_details.append(f"you are a {course} student")
+    if stored_details.get('caste'):
+        known_details.append(f"your category is {stored_details['caste'].upper()}")
+    if stored_details.get('income'):
+        known_details.append(f"your family income is {stored_details['income']}")
+    if stored_details.get('gender'):
+        known_details.append(f"you are a {stored_details['gender']} student")
+    
+    if scholarship_type != 'unspecified':
+        known_details.append(f"you are looking for {scholarship_type} scholarships")
+    
+    if known_details:
+        summary += ", ".join(known_details) + "."
+    else:
+        summary = f"I know you're looking for {scholarship_type} scholarships."
+    
+    details_str = ""
+    if user_details:
+        details_str = "\nUser profile from current query:\n" + _details_lines(user_details)
+    
+    return f"""
 The user said: "{user_input}" and selected the scholarship type: {scholarship_type.capitalize() if scholarship_type != 'unspecified' else 'Unspecified'}.
 {summary}
 {details_str}
 Your task is to:
 1. List 2–3 relevant scholarships in Maharashtra for the {scholarship_type} type in this compact format:
 
-🎓 **[Scholarship Name]**  
-**Level:** [UG / PG / Both]  
-**Category:** [SC / ST / OBC / General / Minority / Girls]  
-**Description:** [Short 1-line purpose of scholarship]  
-**Portal:** [Application or Info URL]
+{SCHOLARSHIP_FORMAT}
 
 2. Ensure scholarships match the user's profile (if details provided) and are specific to Maharashtra.
 3. End with: "Would you like more details on any of these scholarships or help with the application process?"
@@ -570,34 +781,62 @@ Example scholarships (customize based on type):
 - NGO: ONGC Foundation Scholarship, KC Mahindra Scholarship
 - College: Mumbai University Merit Scholarship, Pune University Endowment Scholarship
 
-{common_mistakes}
+{COMMON_MISTAKES}
 
 {fallback_question}
 """
+
+# Prompt renderer for each intent
+_PROMPT_RENDERERS = {
+    **{intent: _render_template(template) for intent, template in _TEMPLATES.items()},
+    'scholarship_query': _render_scholarship_query,
+    'scholarship_personalized': _render_scholarship_personalized,
+    'scholarship_type_selection': _render_scholarship_type_selection
+}
+_render_default = _render_template(_DEFAULT_TEMPLATE)
+
+# Intents whose prompt uses neither the stored profile nor the follow-up question
+_PROFILE_FREE_INTENTS = frozenset({'bot_functionality'})
+
+def create_scholarship_prompt(user_input, query_type, user_details=None):
+    logger.debug("Creating prompt for query type: %s", query_type)
     
-    return f"""
-Unhandled intent: {query_type}. Redirect to scholarship help.
-Example: "I'm here for Maharashtra scholarships (government, private, NGO, college). Which type are you looking for?"
-{common_mistakes}
+    render = _PROMPT_RENDERERS.get(query_type, _render_default)
+    if query_type in _PROFILE_FREE_INTENTS:
+        return render(user_input, query_type, user_details, {}, '')
+    
+    recent_user = get_recent_user()
+    stored_scholarship_type = recent_user.scholarship_type if recent_user and recent_user.scholarship_type != 'unspecified' else None
+    stored_details = {}
+    if recent_user:
+        stored_details = dict(zip(USER_FIELDS, _get_user_fields(recent_user)))
+        stored_details['scholarship_type'] = stored_scholarship_type
+    
+    # Determine missing details for fallback question
+    current_details = user_details or {}
+    missing_details = get_missing_details({**stored_details, **current_details})
+    fallback_question = create_fallback_question(missing_details)
+    
+    return render(user_input, query_type, user_details, stored_details, fallback_question)
 
-{fallback_question}
-"""
+# Precompiled patterns for format_response
+_RE_BLANK = re.compile(r'\n{3,}')
+_RE_HEADING = re.compile(r'(#{1,6})\s*([^\n]+)')
+_RE_BULLET = re.compile(r'^\s*[•·]\s*', re.MULTILINE)
+_RE_QUESTION = re.compile(r'(Would you like|Can you share|Are you|Do you|What is).*\?')
 
 def format_response(text):
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = re.sub(r'(#{1,6})\s*([^\n]+)', r'\1 \2', text)
-    text = re.sub(r'^\s*[•·]\s*', '• ', text, flags=re.MULTILINE)
+    text = _RE_BLANK.sub('\n\n', text)
+    text = _RE_HEADING.sub(r'\1 \2', text)
+    text = _RE_BULLET.sub('• ', text)
     
     # Ensure the fallback question is properly formatted
-    text = re.sub(r'(Would you like|Can you share|Are you|Do you|What is).*\?', 
-                 lambda m: "\n\n" + m.group(0), text)
+    text = _RE_QUESTION.sub('\n\n\\g<0>', text)
     
-    lines = text.split('\n')
-    cleaned_lines = [line.rstrip() for line in lines]
-    text = '\n'.join(cleaned_lines)
+    text = '\n'.join(line.rstrip() for line in text.split('\n'))
     
     # Ensure the response ends with a question
-    if not any(punct in text[-1] for punct in ['?', '!']):
+    if not text.endswith(('?', '!')):
         text += "\n\nWould you like more information about any of these scholarships?"
     
     return text.strip()
@@ -614,205 +853,431 @@ def validate_input(user_input):
     
     return True, user_input.strip()
 
-@app.route('/chat', methods=['POST'])
-def chat_with_gemini():
+def merge_user_details(user_input, query_type, user_details):
+    """
+    Work out the user profile after this turn without touching the database.
+    Returns (values, profile): the column values this turn writes and the resulting RecentUser.
+    """
+    existing_user = get_recent_user()
+    # Only non-None fields are written, so stored details (including scholarship_type) are kept
+    values = {k: v for k, v in user_details.items() if v is not None and k in UserDetails.__table__.c}
+    values.update(query=user_input, intent=query_type, timestamp=datetime.utcnow())
+    
+    if existing_user:
+        return values, existing_user._replace(**values)
+    
+    profile = dict.fromkeys(RecentUser._fields)
+    profile.update(values)
+    # Fields this turn didn't mention are None here and must not bypass the column default
+    profile['scholarship_type'] = profile['scholarship_type'] or 'unspecified'
+    return values, RecentUser(**profile)
+
+def write_user_details(profile, values):
+    """
+    Persist a merged profile: a single UPDATE of this turn's columns, or an INSERT on the first turn.
+    Returns the stored profile; re-raises if the commit fails.
+    """
+    try:
+        # Core statements: no ORM instance, attribute tracking or flush bookkeeping
+        if profile.id is not None:
+            # The row is only rewritten if some column actually differs (e.g. not for a repeated
+            # query). This is checked against the row itself: the process snapshot may be stale.
+            columns = UserDetails.__table__.c
+            changed = or_(*(columns[k].is_distinct_from(v) for k, v in values.items() if k != 'timestamp'))
+            result = db.session.execute(
+                update(UserDetails).where(UserDetails.id == profile.id, changed).values(**values)
+            )
+            logger.debug("Updated user details for record ID %s (%s rows): %s", profile.id, result.rowcount, values)
+        else:
+            result = db.session.execute(insert(UserDetails).values(**profile._replace(id=None)._asdict()))
+            profile = profile._replace(id=result.inserted_primary_key[0])
+            logger.debug("Created new user details record: %s", values)
+        db.session.commit()
+        logger.debug("Successfully stored/updated user details: %s", values)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Database storage error: {str(e)}")
+        raise
+    
+    set_recent_user(profile)
+    return profile
+
+def store_user_details(user_input, query_type, user_details):
+    """
+    Merge the extracted details into the stored user profile.
+    Returns the current user profile; re-raises if the commit fails.
+    """
+    values, profile = merge_user_details(user_input, query_type, user_details)
+    current_user = write_user_details(profile, values)
+    
+    # Log current database state for debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Current database state: %s", current_user._asdict())
+    
+    return current_user
+
+def build_answer_request(full_prompt):
+    """Request body for the Gemini answer generation"""
+    return {
+        "systemInstruction": {"parts": [{"text": CHAT_SYSTEM_INSTRUCTION}]},
+        "contents": [{"parts": [{"text": full_prompt}]}],
+        "generationConfig": {
+            "temperature": 0.7,
+            "topK": 40,
+            "topP": 0.95,
+            "maxOutputTokens": 2048,
+        }
+    }
+
+def stream_gemini_answer(full_prompt):
+    """Yield answer text chunks from Gemini's server-sent event stream"""
+    params = {'key': GEMINI_API_KEY, 'alt': 'sse'}
+
+    with get_session().post(
+        GEMINI_STREAM_URL,
+        params=params,
+        data=orjson.dumps(build_answer_request(full_prompt)),
+        stream=True,
+        timeout=30
+    ) as response:
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError(f'Gemini API error: {response.status_code}', response=response)
+        for line in response.iter_lines():
+            if not line.startswith(b'data:'):
+                continue
+            chunk = orjson.loads(line[len(b'data:'):])
+            for candidate in chunk.get('candidates', [])[:1]:
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+
+def json_response(obj, status=200):
+    """JSON response encoded with orjson instead of Flask's stdlib-json jsonify; bytes are sent as-is"""
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj, default=str, option=ORJSON_OPTIONS)
+    return Response(body, status=status, mimetype='application/json')
+
+# Pre-encoded bodies for the fixed error messages (Response objects themselves are
+# not shared, since after_request handlers such as CORS add headers to them)
+ERR_NO_JSON = orjson.dumps({'error': 'No JSON data provided'})
+ERR_INVALID_JSON = orjson.dumps({'error': 'Request body is not valid JSON'})
+ERR_NO_API_KEY = orjson.dumps({'error': 'GEMINI_API_KEY not configured'})
+ERR_NO_RESPONSE = orjson.dumps({'error': 'No response generated from Gemini'})
+ERR_TIMEOUT = orjson.dumps({'error': 'Request timeout. Please try again.'})
+ERR_NOT_FOUND = orjson.dumps({'error': 'Endpoint not found'})
+ERR_METHOD_NOT_ALLOWED = orjson.dumps({'error': 'Method not allowed'})
+ERR_INTERNAL = orjson.dumps({'error': 'Internal server error'})
+
+def read_json_body():
+    """
+    Parse the request body with orjson straight from the raw bytes, without Flask
+    caching the body or the parsed result on the request.
+    Returns (data, None) or (None, error_body) for a missing or malformed body.
+    """
+    raw = request.get_data(cache=False)
+    if not raw:
+        return None, ERR_NO_JSON
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None, ERR_INVALID_JSON
+    if not data or not isinstance(data, dict):
+        return None, ERR_NO_JSON
+    return data, None
+
+# With CACHE_FALLBACK=1, a Gemini timeout or network error is answered with the last
+# cached answer for the query, even an expired one, instead of a 504/500
+CACHE_FALLBACK = os.environ.get('CACHE_FALLBACK', '0') == '1'
+STALE_WARNING = '110 - "Response is stale"'
+
+def stale_fallback(user_input, query_type, user_details, cache_query, cache_namespace):
+    """(payload, 200) built from a possibly expired cache entry, or None when there is nothing to serve"""
+    if not CACHE_FALLBACK or cache_query is None:
+        return None
+    stale_text = semantic_cache.lookup_stale(cache_query, cache_namespace)
+    if stale_text is None:
+        return None
+    logger.warning("Gemini unavailable, serving stale cached response for: %s", user_input)
+    g.response_warning = STALE_WARNING
+    return chat_success_payload(user_input, stale_text, query_type, user_details, 'stale_cache'), 200
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {orjson.dumps(payload, option=ORJSON_OPTIONS).decode()}\n\n"
+
+def profile_key(user):
+    """Hashable snapshot of the stored profile, used to namespace cached answers"""
+    if not user:
+        return ()
+    return _get_user_fields(user)
+
+# Metadata fields that are the same for every successful chat response
+_BASE_METADATA = MappingProxyType({
+    'response_type': 'scholarship_info',
+    'includes_links': True,
+    'includes_common_mistakes': True
+})
+
+def chat_success_payload(user_input, text, query_type, user_details, source):
+    return {
+        'success': True,
+        'response': text,
+        'formatted_markdown': text,
+        'metadata': {
+            **_BASE_METADATA,
+            'query': user_input,
+            'source': source,
+            'timestamp': datetime.utcnow(),
+            'scholarship_type_stored': user_details.get('scholarship_type', 'unspecified'),
+            'intent_detected': query_type
+        }
+    }
+
+def _handle_chat(user_input):
+    """
+    Run one chat turn for the given query.
+    Returns a (payload, status_code) tuple for the caller to serialize;
+    fixed error payloads are already encoded bytes.
+    """
+    query_type = user_details = cache_query = cache_namespace = None
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'No JSON data provided'}), 400
-        
-        user_input = data.get('query', '')
-        
         is_valid, result = validate_input(user_input)
         if not is_valid:
-            return jsonify({'error': result}), 400
+            return {'error': result}, 400
         
         user_input = result
-        logger.debug(f"Processing chat query: {user_input}")
+        logger.debug("Processing chat query: %s", user_input)
         
-        # Use Gemini for both intent detection and entity extraction
-        query_type = analyze_query_type(user_input)
-        user_details = extract_user_details_with_gemini(user_input)
+        # One Gemini call for both intent detection and entity extraction
+        query_type, user_details = classify_and_extract(user_input)
         
-        with app.app_context():
-            # Validate extracted details
-            valid_details = {k: v for k, v in user_details.items() if v is not None}
-            valid_details['intent'] = query_type  # Store the detected intent
-            
-            logger.debug(f"Valid details to store: {valid_details}")
-            
-            if valid_details:
-                existing_user = db.session.query(UserDetails).order_by(UserDetails.timestamp.desc()).first()
-                
-                if existing_user:
-                    # Update only non-None fields, preserving scholarship_type unless explicitly changed
-                    existing_user.query = user_input
-                    existing_user.intent = query_type
-                    existing_user.timestamp = datetime.utcnow()
-                    
-                    for key, value in valid_details.items():
-                        if key != 'scholarship_type' or (key == 'scholarship_type' and value is not None):
-                            setattr(existing_user, key, value)
-                    
-                    logger.debug(f"Updated user details for record ID {existing_user.id}: {valid_details}")
-                else:
-                    new_user = UserDetails(
-                        query=user_input,
-                        caste=user_details.get('caste'),
-                        income=user_details.get('income'),
-                        gender=user_details.get('gender'),
-                        course_level=user_details.get('course_level'),
-                        is_hostel=user_details.get('is_hostel'),
-                        cgpa=user_details.get('cgpa'),
-                        is_minority=user_details.get('is_minority'),
-                        has_disability=user_details.get('has_disability'),
-                        ex_serviceman_parent=user_details.get('ex_serviceman_parent'),
-                        scholarship_type=user_details.get('scholarship_type', 'unspecified'),
-                        intent=query_type
-                    )
-                    db.session.add(new_user)
-                    logger.debug(f"Created new user details record: {valid_details}")
-                
-                try:
-                    db.session.commit()
-                    logger.info(f"Successfully stored/updated user details: {valid_details}")
-                except Exception as e:
-                    db.session.rollback()
-                    logger.error(f"Database storage error: {str(e)}")
-                    return jsonify({'error': f'Failed to store user details: {str(e)}'}), 500
-            else:
-                logger.warning(f"No valid details extracted from input: {user_input}")
-            
-            # Log current database state for debugging
-            current_user = db.session.query(UserDetails).order_by(UserDetails.timestamp.desc()).first()
-            if current_user:
-                current_state = {c.name: getattr(current_user, c.name) for c in current_user.__table__.columns}
-                logger.debug(f"Current database state: {current_state}")
+        # The updated profile is known before it is written, so the write can be deferred:
+        # on the generation path it then overlaps the Gemini round trip
+        values, current_user = merge_user_details(user_input, query_type, user_details)
+        g.recent_user = current_user
+        
+        def save_failed():
+            try:
+                write_user_details(current_user, values)
+            except Exception as e:
+                return {'error': f'Failed to store user details: {str(e)}'}, 500
+            return None
+        
+        # Greetings, small talk and capability questions don't need a generation
+        if query_type in CANNED_RESPONSES:
+            return save_failed() or (chat_success_payload(user_input, random.choice(CANNED_RESPONSES[query_type]), query_type, user_details, 'canned'), 200)
         
         if not GEMINI_API_KEY:
             logger.error("GEMINI_API_KEY not configured")
-            return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
+            return save_failed() or (ERR_NO_API_KEY, 500)
         
-        full_prompt = create_scholarship_prompt(user_input, user_details)
-        logger.debug(f"Generated prompt: {full_prompt[:200]}...")
-
-        # Add instructions to ensure chatbot knows answers to fallback questions
-        full_prompt += """
-IMPORTANT INSTRUCTIONS FOR THE CHATBOT:
-1. You MUST maintain the response structure: 
-   - First provide scholarship information based on known user details
-   - Then ask ONE relevant follow-up question at the end
-
-2. For follow-up questions:
-   - If user hasn't provided key details (caste, income, etc.), ask for those
-   - If all details are provided, ask if they want application process info
-   - Keep questions simple and one at a time
-
-3. You MUST know the answers to your own follow-up questions. For example:
-   - If asking about caste, be ready to explain different categories
-   - If asking about application process, be ready to guide them
-   - If asking about income, know the typical ranges
-
-4. Always end with a question to keep the conversation flowing.
-"""
+        # Serve near-duplicate queries for the same intent and profile from the cache
+        cache_query = cache_query_for(user_input)
+        cache_namespace = (query_type, profile_key(current_user))
+        cached_text = semantic_cache.lookup(cache_query, cache_namespace)
+        if cached_text is not None:
+            logger.debug("Serving cached response for: %s", user_input)
+            return save_failed() or (chat_success_payload(user_input, cached_text, query_type, user_details, 'semantic_cache'), 200)
+        
+        full_prompt = create_scholarship_prompt(user_input, query_type, user_details)
+        logger.debug("Generated prompt: %s...", full_prompt[:200])
 
-        headers = {'Content-Type': 'application/json'}
-        data = {
-            "contents": [{"parts": [{"text": full_prompt}]}],
-            "generationConfig": {
-                "temperature": 0.7,
-                "topK": 40,
-                "topP": 0.95,
-                "maxOutputTokens": 2048,
-            }
-        }
+        data = build_answer_request(full_prompt)
         params = {'key': GEMINI_API_KEY}
 
-        response = requests.post(
+        future = _gemini_executor.submit(
+            get_session().post,
             GEMINI_API_URL,
-            headers=headers,
             params=params,
-            json=data,
+            data=orjson.dumps(data),
             timeout=30
         )
+        failed = save_failed()
+        if failed:
+            if future.cancel():
+                return failed
+            # Gemini is already generating (and billing) this answer, so serve it unsaved
+            logger.error("Returning the answer without saving the user details")
+        # requests' timeout bounds each socket read; this bounds the whole call
+        response = future.result(timeout=GEMINI_ANSWER_TIMEOUT)
 
         if response.status_code == 200:
-            content = response.json()
+            content = orjson.loads(response.content)
             if 'candidates' in content and len(content['candidates']) > 0:
                 generated_text = content['candidates'][0]['content']['parts'][0]['text']
                 formatted_text = format_response(generated_text)
-                logger.info(f"Generated response: {formatted_text[:100]}...")
-                return jsonify({
-                    'success': True,
-                    'response': formatted_text,
-                    'formatted_markdown': formatted_text,
-                    'metadata': {
-                        'query': user_input,
-                        'response_type': 'scholarship_info',
-                        'source': 'gemini_knowledge',
-                        'timestamp': str(datetime.now().isoformat()),
-                        'includes_links': True,
-                        'includes_common_mistakes': True,
-                        'scholarship_type_stored': user_details.get('scholarship_type', 'unspecified'),
-                        'intent_detected': query_type
-                    }
-                })
+                logger.debug("Generated response: %s...", formatted_text[:100])
+                semantic_cache.store(cache_query, formatted_text, cache_namespace)
+                return chat_success_payload(user_input, formatted_text, query_type, user_details, 'gemini_knowledge'), 200
             else:
                 logger.error("No response generated from Gemini")
-                return jsonify({'error': 'No response generated from Gemini'}), 500
+                return ERR_NO_RESPONSE, 500
         else:
             error_message = f'Gemini API error: {response.status_code}'
             try:
-                error_detail = response.json()
+                error_detail = orjson.loads(response.content)
                 if 'error' in error_detail:
                     error_message += f" - {error_detail['error'].get('message', 'Unknown error')}"
-            except:
-                error_message += f" - {response.text[:200]}"
+            except (orjson.JSONDecodeError, TypeError, AttributeError):
+                error_message += f" - {response.content[:200].decode('utf-8', 'replace')}"
             logger.error(error_message)
-            return jsonify({'error': error_message}), response.status_code
+            return {'error': error_message}, response.status_code
             
-    except requests.exceptions.Timeout:
+    except (requests.exceptions.Timeout, FutureTimeoutError):
         logger.error("Request timeout")
-        return jsonify({'error': 'Request timeout. Please try again.'}), 504
+        return stale_fallback(user_input, query_type, user_details, cache_query, cache_namespace) or (ERR_TIMEOUT, 504)
     except requests.exceptions.RequestException as e:
         logger.error(f"Network error: {str(e)}")
-        return jsonify({'error': f'Network error: {str(e)}'}), 500
+        return stale_fallback(user_input, query_type, user_details, cache_query, cache_namespace) or ({'error': f'Network error: {str(e)}'}, 500)
     except Exception as e:
         logger.error(f"Server error: {str(e)}")
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+        return {'error': f'Server error: {str(e)}'}, 500
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({
+@app.route('/chat', methods=['POST'])
+def chat_with_gemini():
+    data, error = read_json_body()
+    if error:
+        return json_response(error, 400)
+    
+    body, status = _handle_chat(data.get('query', ''))
+    response = json_response(body, status)
+    warning = g.get('response_warning')
+    if warning:
+        response.headers['Warning'] = warning
+    return response
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Same flow as /chat, but the Gemini answer is relayed as server-sent events:
+    'chunk' events carry text as it is generated, and a final 'done' event carries
+    the formatted response in the /chat envelope ('error' on failure).
+    """
+    data, error = read_json_body()
+    if error:
+        return json_response(error, 400)
+    
+    is_valid, result = validate_input(data.get('query', ''))
+    if not is_valid:
+        return json_response({'error': result}, 400)
+    
+    user_input = result
+    logger.debug("Processing streaming chat query: %s", user_input)
+    
+    query_type, user_details = classify_and_extract(user_input)
+    
+    try:
+        current_user = store_user_details(user_input, query_type, user_details)
+    except Exception as e:
+        return json_response({'error': f'Failed to store user details: {str(e)}'}, 500)
+    
+    full_prompt = None
+    if query_type in CANNED_RESPONSES:
+        ready_text, source = random.choice(CANNED_RESPONSES[query_type]), 'canned'
+    elif not GEMINI_API_KEY:
+        logger.error("GEMINI_API_KEY not configured")
+        return json_response(ERR_NO_API_KEY, 500)
+    else:
+        # Only turns that may reach Gemini need a cache key (and the lemmatizer)
+        cache_query = cache_query_for(user_input)
+        cache_namespace = (query_type, profile_key(current_user))
+        ready_text, source = semantic_cache.lookup(cache_query, cache_namespace), 'semantic_cache'
+        if ready_text is None:
+            full_prompt = create_scholarship_prompt(user_input, query_type, user_details)
+    
+    def generate():
+        if full_prompt is None:
+            yield sse_event('done', chat_success_payload(user_input, ready_text, query_type, user_details, source))
+            return
+        
+        chunks = []
+        try:
+            for text in stream_gemini_answer(full_prompt):
+                chunks.append(text)
+                yield sse_event('chunk', {'text': text})
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Network error while streaming: {str(e)}")
+            yield sse_event('error', {'error': f'Network error: {str(e)}'})
+            return
+        except Exception as e:
+            # e.g. a malformed data: line or an unexpected chunk shape; the client
+            # still needs a terminal event instead of a half-finished answer
+            logger.error(f"Server error while streaming: {str(e)}")
+            yield sse_event('error', {'error': f'Server error: {str(e)}'})
+            return
+        
+        if not chunks:
+            logger.error("No response generated from Gemini")
+            yield sse_event('error', {'error': 'No response generated from Gemini'})
+            return
+        
+        formatted_text = format_response(''.join(chunks))
+        semantic_cache.store(cache_query, formatted_text, cache_namespace)
+        yield sse_event('done', chat_success_payload(user_input, formatted_text, query_type, user_details, 'gemini_knowledge'))
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+# Static part of the /health payload; none of it can change while the process runs.
+# It is pre-encoded up to the opening quote of the timestamp value.
+with app.app_context():
+    _HEALTH_PREFIX = orjson.dumps({
         'status': 'healthy',
-        'timestamp': str(datetime.now()),
         'database': 'connected' if db.engine else 'disconnected',
         'gemini_api': 'configured' if GEMINI_API_KEY else 'not_configured'
-    })
+    })[:-1] + b',"timestamp":"'
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    body = _HEALTH_PREFIX + datetime.utcnow().isoformat().encode() + b'Z"}'
+    return Response(body, mimetype='application/json')
+
+# JSON error pages instead of Werkzeug's HTML ones, from the pre-encoded bodies
+@app.errorhandler(404)
+def not_found(error):
+    return json_response(ERR_NOT_FOUND, 404)
+
+@app.errorhandler(405)
+def method_not_allowed(error):
+    response = json_response(ERR_METHOD_NOT_ALLOWED, 405)
+    if error.valid_methods:
+        response.headers['Allow'] = ', '.join(error.valid_methods)
+    return response
+
+@app.errorhandler(500)
+def internal_error(error):
+    return json_response(ERR_INTERNAL, 500)
 
 if __name__ == '__main__':
-    logger.info("Starting Enhanced Maharashtra Scholarship Assistant with Gemini-powered entity extraction...")
-    logger.info(f"GEMINI_API_KEY configured: {'Yes' if GEMINI_API_KEY else 'No'}")
-    logger.info(f"Database configured: {'Yes' if app.config['SQLALCHEMY_DATABASE_URI'] else 'No'}")
-    logger.info("\nAvailable endpoints:")
-    logger.info("  POST /chat - Main chat endpoint for scholarship queries")
-    logger.info("  GET  /health - Health check and status")
-    logger.info("\nKey Features:")
-    logger.info("  - Gemini-powered intent detection and entity extraction")
-    logger.info("  - Persistent user profile tracking")
-    logger.info("  - Smart fallback questions to gather more details")
-    logger.info("  - Structured responses with scholarship info first, questions last")
+    if not ensure_wordnet():
+        logger.warning("WordNet download failed; answers will be cached without lemmatization")
+    
+    logger.info("\n".join([
+        "Starting Enhanced Maharashtra Scholarship Assistant with Gemini-powered entity extraction...",
+        f"GEMINI_API_KEY configured: {'Yes' if GEMINI_API_KEY else 'No'}",
+        f"Database configured: {'Yes' if app.config['SQLALCHEMY_DATABASE_URI'] else 'No'}",
+        "\nAvailable endpoints:",
+        "  POST /chat - Main chat endpoint for scholarship queries",
+        "  POST /chat/stream - Same as /chat, streamed as server-sent events",
+        "  GET  /health - Health check and status",
+        "\nKey Features:",
+        "  - Gemini-powered intent detection and entity extraction",
+        "  - Persistent user profile tracking",
+        "  - Smart fallback questions to gather more details",
+        "  - Structured responses with scholarship info first, questions last",
+    ]))
     
     if not GEMINI_API_KEY:
-        logger.warning("GEMINI_API_KEY not configured!")
-        logger.warning("Set your Gemini API key: export GEMINI_API_KEY='your_api_key_here'")
-        logger.warning("Get API key from: https://aistudio.google.com/app/apikey")
+        logger.warning("\n".join([
+            "GEMINI_API_KEY not configured!",
+            "Set your Gemini API key: export GEMINI_API_KEY='your_api_key_here'",
+            "Get API key from: https://aistudio.google.com/app/apikey",
+        ]))
     
     if not app.config['SECRET_KEY'] or app.config['SECRET_KEY'] == 'default-secret-key':
-        logger.warning("FLASK_SECRET_KEY not configured or using default!")
-        logger.warning("Set a secure key: export FLASK_SECRET_KEY='your_secure_key_here'")
+        logger.warning("\n".join([
+            "FLASK_SECRET_KEY not configured or using default!",
+            "Set a secure key: export FLASK_SECRET_KEY='your_secure_key_here'",
+        ]))
     
-    logger.info("\nReady to assist with Maharashtra scholarship queries with Gemini-powered entity extraction!")
-    logger.info("="*60)
+    logger.info("\nReady to assist with Maharashtra scholarship queries with Gemini-powered entity extraction!\n" + "="*60)
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Debug mode (reloader, pretty-printed output) is opt-in via FLASK_DEBUG=1
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,58 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of cached responses across all namespaces
+MAX_ENTRIES = 10000
+
+# Seconds a generated answer may be reused before Gemini is asked again
+TTL = int(os.environ.get('ANSWER_CACHE_TTL', 600))
+
+_WORD_RE = re.compile(r'\w+')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+def normalize(query):
+    """
+    Reduce a (lemmatized) query to a canonical form so paraphrases that only
+    differ in case, punctuation or spacing share an entry. Word order is kept:
+    "girls not boys" and "boys not girls" ask different things.
+    """
+    return ' '.join(_WORD_RE.findall(query.lower()))
+
+def lookup(query, namespace):
+    """Return the cached response for a near-duplicate query, or None on a miss."""
+    key = (namespace, normalize(query))
+    response = None
+    with _lock:
+        entry = _cache.get(key)
+        # Expired entries are left in place (store overwrites them, LRU evicts them)
+        # so lookup_stale can still fall back to them when Gemini is unreachable
+        if entry is not None and entry[0] >= time.monotonic():
+            response = entry[1]
+            _cache.move_to_end(key)
+    if response is not None:
+        logger.debug("Semantic cache hit for query: %s", query)
+    return response
+
+def lookup_stale(query, namespace):
+    """Return the cached response for a near-duplicate query even if it has expired, or None."""
+    key = (namespace, normalize(query))
+    with _lock:
+        entry = _cache.get(key)
+    return None if entry is None else entry[1]
+
+def store(query, response, namespace):
+    """Cache a response for TTL seconds, evicting the least recently used entry when full."""
+    key = (namespace, normalize(query))
+    with _lock:
+        _cache[key] = (time.monotonic() + TTL, response)
+        _cache.move_to_end(key)
+        if len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)